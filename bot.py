@@ -1,18 +1,32 @@
 import os
+import io
+import atexit
+import signal
 import asyncio
 import tempfile
+import time
+import uuid
+import hashlib
 import sqlite3
+import threading
+import queue
+from collections import OrderedDict, defaultdict
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal, ROUND_HALF_UP
 from datetime import datetime, timezone
-from typing import Optional, List, Tuple, Literal
+from functools import lru_cache, partial, wraps
+from typing import Optional, List, Set, Tuple, Dict, DefaultDict, Literal, Iterator, Union
 
 import re
+import html
 
 import discord
 from discord.ext import commands
 from discord import app_commands, Interaction
 from discord.ui import View, Select, Button, Modal, TextInput
 
-import gdown
+import aiohttp
 from aiohttp import web
 
 # ======================
@@ -31,14 +45,17 @@ LOG_TOPUP_CHANNEL_ID = int(os.getenv("LOG_TOPUP_CHANNEL_ID", "0"))        # ห
 # LOG_TOPUP_CHANNEL_ID = 456789012345678901
 
 # ---------- Healthcheck for Render ----------
+# body เป็น bytes คงที่ ไม่ต้อง encode ทุกครั้ง (Response ต้องสร้างใหม่ต่อ request เพราะใช้ซ้ำไม่ได้)
+_HEALTH_BODY = b"ok"
+
 async def _health(request):
-    return web.Response(text="ok")
+    return web.Response(body=_HEALTH_BODY, content_type="text/plain")
 
 async def run_web_server():
-    app = web.Application()
-    app.router.add_get("/", _health)
+    # มีแค่ health check: ใช้ low-level server (ไม่มี router/middleware) และปิด access log
+    server = web.Server(_health, access_log=None)
     port = int(os.getenv("PORT", "8080"))
-    runner = web.AppRunner(app)
+    runner = web.ServerRunner(server)
     await runner.setup()
     site = web.TCPSite(runner, "0.0.0.0", port)
     await site.start()
@@ -57,131 +74,391 @@ INTENTS.guilds = True
 INTENTS.members = True   # สำคัญสำหรับ user picker
 INTENTS.message_content = False
 
-bot = commands.Bot(command_prefix="!", intents=INTENTS)
+TEST_GUILD_ID = int(os.getenv("TEST_GUILD_ID", "0"))  # ถ้าตั้งไว้ จะ sync คำสั่งเข้ากิลด์นี้ทันที (ใช้ทดสอบ)
+
+class ShopBot(commands.Bot):
+    async def setup_hook(self):
+        # เรียกครั้งเดียวหลัง login ก่อนต่อ gateway: ไม่ซ้ำตอน reconnect เหมือน on_ready
+        # health server ล้มเหลว (เช่น port ถูกใช้อยู่) ไม่ควรทำให้บอททั้งตัวไม่ขึ้น
+        try:
+            await run_web_server()
+        except OSError as e:
+            print("[web] failed to start:", e)
+
+        # persistent view (เมนูไม่หมดอายุจนกว่าจะรีสตาร์ทบอท)
+        self.add_view(MenuView())
+
+        # เก็บ reference ไว้ ไม่งั้น task อาจถูก GC ทิ้งกลางทาง
+        self.prefetch_task = asyncio.create_task(prefetch_active_items())
+
+        # sync แบบ global ครั้งเดียว (ไม่วน sync ทีละกิลด์)
+        # โหมดทดสอบ (TEST_GUILD_ID) sync เฉพาะกิลด์นั้นอย่างเดียว ไม่งั้นคำสั่งจะขึ้นซ้ำ 2 ชุดในกิลด์ทดสอบ
+        try:
+            if TEST_GUILD_ID > 0:
+                guild = discord.Object(id=TEST_GUILD_ID)
+                self.tree.copy_global_to(guild=guild)
+                await self.tree.sync(guild=guild)
+                print(f"Synced commands to test guild {TEST_GUILD_ID}")
+            else:
+                synced = await self.tree.sync()
+                print(f"Synced {len(synced)} global commands")
+        except Exception as e:
+            print("Command sync error:", e)
+
+    async def close(self):
+        await super().close()
+        # session กลางของ aiohttp (ดาวน์โหลดจาก Drive) ปิดตอนบอทปิด ไม่งั้นจะเตือน "Unclosed client session"
+        if _HTTP is not None and not _HTTP.closed:
+            await _HTTP.close()
+
+bot = ShopBot(command_prefix="!", intents=INTENTS)
 
 # ---------- UTILS ----------
 def to_satang(thb: float) -> int:
-    return int(round(thb * 100))
+    # แปลงผ่าน str/Decimal กัน float เพี้ยน (เช่น 0.1*3 ได้ 29 สตางค์) และปัดครึ่งขึ้นแบบเงินจริง
+    return int((Decimal(str(thb)) * 100).quantize(Decimal("1"), rounding=ROUND_HALF_UP))
 
+@lru_cache(maxsize=4096)
 def fmt_thb(satang: int) -> str:
-    return f"{satang/100:.2f} บาท"
+    sign = "-" if satang < 0 else ""
+    baht, sat = divmod(abs(satang), 100)
+    return f"{sign}{baht}.{sat:02d} บาท"
 
 def now_utc_iso() -> str:
     return datetime.now(timezone.utc).isoformat()
 
+def now_ts() -> int:
+    return int(time.time())
+
+def fmt_ts(ts: int) -> str:
+    return datetime.fromtimestamp(ts, timezone.utc).isoformat(timespec="seconds")
+
+def fmt_history(rows: List[dict]) -> str:
+    return "\n".join(
+        "- {0} | {1} | {2}".format(r["name"], fmt_thb(r["price_cents"]), fmt_ts(r["created_at"]))
+        for r in rows
+    )
+
+_DIGIT_RE = re.compile(r'\d+')
+
 def parse_user_id(text: str) -> Optional[int]:
-    if not text:
-        return None
-    s = text.strip()
-    s = s.strip("<>@!#& ")
-    digits = "".join(ch for ch in s if ch.isdigit())
-    if digits:
-        try:
-            return int(digits)
-        except Exception:
-            return None
-    return None
+    # รับได้ทั้ง <@123>, <@!123> หรือ ID ตรง ๆ: ใช้ตัวเลขชุดแรกที่เจอ
+    m = _DIGIT_RE.search(text or "")
+    return int(m.group()) if m else None
 
 # ---------- DB ----------
-def db() -> sqlite3.Connection:
-    conn = sqlite3.connect(DB_PATH)
+# writer 1 ตัว (ล็อก + BEGIN IMMEDIATE) และ reader หลายตัว (query_only) บนไฟล์ WAL เดียวกัน
+# อ่านประวัติ/เมนูได้พร้อมกันระหว่างที่มีการซื้อกำลัง commit
+READ_POOL_SIZE = max(2, os.cpu_count() or 2)
+
+_PRAGMAS = (
+    "PRAGMA busy_timeout=5000",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA cache_size=-64000",
+    "PRAGMA mmap_size=268435456",
+    "PRAGMA temp_store=MEMORY",
+)
+
+def _connect(read_only: bool = False) -> sqlite3.Connection:
+    conn = sqlite3.connect(DB_PATH, check_same_thread=False, isolation_level=None)
     conn.row_factory = sqlite3.Row
+    if DB_PATH != ":memory:":
+        conn.execute("PRAGMA journal_mode=WAL")
+    for pragma in _PRAGMAS:
+        conn.execute(pragma)
+    if read_only:
+        conn.execute("PRAGMA query_only=1")
     return conn
 
+class ReadPool:
+    def __init__(self, size: int):
+        self._conns: "queue.LifoQueue[sqlite3.Connection]" = queue.LifoQueue()
+        for _ in range(size):
+            self._conns.put(_connect(read_only=True))
+
+    @contextmanager
+    def connection(self) -> Iterator[sqlite3.Connection]:
+        conn = self._conns.get()
+        try:
+            yield conn
+        finally:
+            self._conns.put(conn)
+
+_WRITER: Optional[sqlite3.Connection] = None
+_WRITE_LOCK = threading.RLock()
+_READ_POOL: Optional[ReadPool] = None
+_INIT_LOCK = threading.Lock()
+
+def _init_connections():
+    global _WRITER, _READ_POOL
+    with _INIT_LOCK:
+        if _WRITER is not None:
+            return
+        # connection ถูกใช้ข้ามเธรด (check_same_thread=False) ต้องเป็น build ที่ thread-safe
+        if sqlite3.threadsafety < 1:
+            raise RuntimeError("sqlite3 build นี้ไม่รองรับการใช้ connection ข้ามเธรด")
+        _WRITER = _connect()
+        # :memory: แต่ละ connection คือคนละฐานข้อมูล จึงให้อ่านผ่าน writer แทน
+        if DB_PATH != ":memory:":
+            _READ_POOL = ReadPool(READ_POOL_SIZE)
+
+@contextmanager
+def read_conn() -> Iterator[sqlite3.Connection]:
+    if _WRITER is None:
+        _init_connections()
+    if _READ_POOL is None:
+        with _WRITE_LOCK:
+            yield _WRITER
+        return
+    with _READ_POOL.connection() as conn:
+        yield conn
+
+@contextmanager
+def write_conn() -> Iterator[sqlite3.Connection]:
+    """ทุกคำสั่งใน block อยู่ใน transaction เดียว (BEGIN IMMEDIATE → COMMIT / ROLLBACK)"""
+    if _WRITER is None:
+        _init_connections()
+    with _WRITE_LOCK:
+        conn = _WRITER
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+# งาน SQLite จาก handler ของ Discord รันบน thread pool แยก ไม่บล็อก event loop (heartbeat/healthcheck)
+_DB_POOL = ThreadPoolExecutor(max_workers=READ_POOL_SIZE + 1, thread_name_prefix="sqlite")
+
+async def _run_db(fn, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_DB_POOL, partial(fn, *args, **kwargs))
+
+def _reload_in_background(fn):
+    # cache ที่หมดอายุ: สั่งโหลดใหม่บน pool แล้วใช้ snapshot เดิมไปก่อน (event loop ไม่ต้องรอ read_conn)
+    def run():
+        try:
+            fn()
+        except Exception as e:
+            print("[db] reload failed:", e)
+    _DB_POOL.submit(run)
+
+# created_at เก็บเป็น epoch seconds (INTEGER) ขนาดคงที่ เรียงได้ และไม่ต้อง parse
+_PURCHASES_DDL = """
+    CREATE TABLE IF NOT EXISTS purchases (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        discord_id INTEGER NOT NULL,
+        item_id INTEGER NOT NULL,
+        price_cents INTEGER NOT NULL,
+        created_at INTEGER NOT NULL,
+        FOREIGN KEY(item_id) REFERENCES items(id)
+    )
+"""
+
+_TRANSFERS_DDL = """
+    CREATE TABLE IF NOT EXISTS transfers (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        from_id INTEGER NOT NULL,
+        to_id INTEGER NOT NULL,
+        amount_cents INTEGER NOT NULL,
+        created_at INTEGER NOT NULL
+    )
+"""
+
+def _migrate_created_at(c: sqlite3.Cursor, table: str, ddl: str):
+    # ฐานข้อมูลเก่าเก็บ created_at เป็นข้อความ ISO => สร้างตารางใหม่แล้วแปลงเป็น epoch
+    cols = c.execute(f"PRAGMA table_info({table})").fetchall()
+    if any(r["name"] == "created_at" and r["type"].upper() == "INTEGER" for r in cols):
+        return
+    names = [r["name"] for r in cols]
+    select = ", ".join(
+        "CAST(strftime('%s', created_at) AS INTEGER)" if n == "created_at" else n for n in names
+    )
+    c.execute(f"ALTER TABLE {table} RENAME TO {table}_old")
+    c.execute(ddl)
+    c.execute(f"INSERT INTO {table} ({', '.join(names)}) SELECT {select} FROM {table}_old")
+    c.execute(f"DROP TABLE {table}_old")
+    print(f"[db] migrated {table}.created_at to epoch seconds")
+
+_SCHEMA = f"""
+    CREATE TABLE IF NOT EXISTS users (
+        discord_id INTEGER PRIMARY KEY,
+        balance_cents INTEGER NOT NULL DEFAULT 0
+    );
+    CREATE TABLE IF NOT EXISTS items (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        name TEXT NOT NULL,
+        price_cents INTEGER NOT NULL,
+        gdrive_url TEXT NOT NULL,
+        filename TEXT DEFAULT 'video.mp4',
+        is_active INTEGER NOT NULL DEFAULT 1
+    );
+    {_PURCHASES_DDL};
+    CREATE TABLE IF NOT EXISTS admins (
+        discord_id INTEGER PRIMARY KEY
+    );
+    CREATE TABLE IF NOT EXISTS settings (
+        key TEXT PRIMARY KEY,
+        value TEXT NOT NULL
+    );
+    INSERT OR IGNORE INTO settings (key, value) VALUES ('shop_open','1');
+    {_TRANSFERS_DDL};
+"""
+
+# สร้าง index หลัง migrate (ตอนสร้างตารางใหม่ index เดิมหายไปพร้อมตาราง _old)
+_INDEXES = """
+    CREATE INDEX IF NOT EXISTS idx_purchases_user ON purchases(discord_id, id DESC);
+    CREATE INDEX IF NOT EXISTS idx_items_active ON items(is_active) WHERE is_active=1;
+    CREATE INDEX IF NOT EXISTS idx_transfers_from ON transfers(from_id, id DESC);
+    CREATE INDEX IF NOT EXISTS idx_transfers_to ON transfers(to_id, id DESC);
+"""
+
 def db_init():
-    with db() as conn:
+    _init_connections()
+    # executescript จะ COMMIT ธุรกรรมที่ค้างอยู่ก่อนเสมอ จึงไม่รันใน write_conn() แต่ครอบ BEGIN/COMMIT เองในสคริปต์
+    with _WRITE_LOCK:
+        _WRITER.executescript(f"BEGIN IMMEDIATE;{_SCHEMA}COMMIT;")
+    with write_conn() as conn:
         c = conn.cursor()
-        c.execute("""
-            CREATE TABLE IF NOT EXISTS users (
-                discord_id INTEGER PRIMARY KEY,
-                balance_cents INTEGER NOT NULL DEFAULT 0
-            )
-        """)
-        c.execute("""
-            CREATE TABLE IF NOT EXISTS items (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                name TEXT NOT NULL,
-                price_cents INTEGER NOT NULL,
-                gdrive_url TEXT NOT NULL,
-                filename TEXT DEFAULT 'video.mp4',
-                is_active INTEGER NOT NULL DEFAULT 1
-            )
-        """)
-        c.execute("""
-            CREATE TABLE IF NOT EXISTS purchases (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                discord_id INTEGER NOT NULL,
-                item_id INTEGER NOT NULL,
-                price_cents INTEGER NOT NULL,
-                created_at TEXT NOT NULL,
-                FOREIGN KEY(item_id) REFERENCES items(id)
-            )
-        """)
-        c.execute("""
-            CREATE TABLE IF NOT EXISTS admins (
-                discord_id INTEGER PRIMARY KEY
-            )
-        """)
-        c.execute("""
-            CREATE TABLE IF NOT EXISTS settings (
-                key TEXT PRIMARY KEY,
-                value TEXT NOT NULL
-            )
-        """)
-        c.execute("INSERT OR IGNORE INTO settings (key, value) VALUES ('shop_open','1')")
-        c.execute("""
-            CREATE TABLE IF NOT EXISTS transfers (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                from_id INTEGER NOT NULL,
-                to_id INTEGER NOT NULL,
-                amount_cents INTEGER NOT NULL,
-                created_at TEXT NOT NULL
-            )
-        """)
-        conn.commit()
+        _migrate_created_at(c, "purchases", _PURCHASES_DDL)
+        _migrate_created_at(c, "transfers", _TRANSFERS_DDL)
+        # ฐานข้อมูลที่ยังไม่เคยเก็บสถิติ: ANALYZE ครั้งแรกให้ planner เลือกใช้ index ได้ถูก
+        need_analyze = c.execute("SELECT 1 FROM sqlite_master WHERE name='sqlite_stat1'").fetchone() is None
+    with _WRITE_LOCK:
+        _WRITER.executescript(f"BEGIN IMMEDIATE;{_INDEXES}{'ANALYZE;' if need_analyze else ''}COMMIT;")
+    _load_settings()
+    _load_admins()
+    _load_item_names()
+    _active_items()
+    db_optimize()
+
+def db_optimize():
+    # ให้ query planner มีสถิติล่าสุด (เรียกตอนเริ่มและก่อนปิดโปรเซส)
+    if _WRITER is None:
+        return
+    with _WRITE_LOCK:
+        _WRITER.execute("PRAGMA analysis_limit=400")
+        _WRITER.execute("PRAGMA optimize")
+        if _WRITER.execute("PRAGMA auto_vacuum").fetchone()[0] == 2:
+            _WRITER.execute("PRAGMA incremental_vacuum")
+
+# settings เปลี่ยนเฉพาะตอนแอดมินสั่ง (เช่น shop_open) และมีไม่กี่แถว => โหลดทั้งตารางด้วย SELECT เดียว
+# เก็บไว้ในหน่วยความจำ เขียนทับตอน set_setting และโหลดใหม่ทุก 60 วิ เผื่อมีคนแก้ไฟล์ DB ตรง ๆ
+# key ที่ไม่มีในตารางก็ไม่ต้อง query ซ้ำ (ไม่อยู่ใน snapshot = ใช้ค่า default)
+_SETTINGS_CACHE: Dict[str, str] = {}
+_SETTINGS_TTL = 60.0
+_settings_loaded_at = float("-inf")
+# ล็อกระหว่างโหลดทั้งตารางกับ write-through ของ set_setting: snapshot ที่อ่านก่อน commit
+# จะไม่ถูกสลับเข้ามาทับค่าที่ set_setting เพิ่งเขียน
+_SETTINGS_LOCK = threading.Lock()
+
+def _load_settings():
+    global _SETTINGS_CACHE, _settings_loaded_at
+    with _SETTINGS_LOCK:
+        with read_conn() as conn:
+            # สลับทั้ง dict ด้วย assignment เดียว คนที่อ่านพร้อมกันไม่เห็น dict ว่างกลางทาง
+            _SETTINGS_CACHE = {r["key"]: r["value"] for r in conn.execute("SELECT key, value FROM settings")}
+        _settings_loaded_at = time.monotonic()
+
+def clear_setting_cache():
+    global _settings_loaded_at
+    _settings_loaded_at = float("-inf")
 
 def get_setting(key: str, default: str = "") -> str:
-    with db() as conn:
-        row = conn.execute("SELECT value FROM settings WHERE key=?", (key,)).fetchone()
-        return row["value"] if row else default
+    global _settings_loaded_at
+    if time.monotonic() - _settings_loaded_at >= _SETTINGS_TTL:
+        # เลื่อนเวลาไว้ก่อน กันสั่งโหลดซ้ำทุกครั้งระหว่างที่ยังโหลดไม่เสร็จ
+        _settings_loaded_at = time.monotonic()
+        _reload_in_background(_load_settings)
+    return _SETTINGS_CACHE.get(key, default)
 
 def set_setting(key: str, value: str):
-    with db() as conn:
+    with write_conn() as conn:
         conn.execute(
             "INSERT INTO settings (key,value) VALUES (?,?) "
             "ON CONFLICT(key) DO UPDATE SET value=excluded.value",
             (key, value),
         )
-        conn.commit()
-
-def ensure_user(discord_id: int):
-    with db() as conn:
-        conn.execute("INSERT OR IGNORE INTO users (discord_id) VALUES (?)", (discord_id,))
-        conn.commit()
+    with _SETTINGS_LOCK:
+        _SETTINGS_CACHE[key] = value
 
 def get_balance(discord_id: int) -> int:
-    ensure_user(discord_id)
-    with db() as conn:
+    # อ่านอย่างเดียว: ผู้ใช้ที่ยังไม่มีแถวถือว่ายอด 0 (แถวถูกสร้างตอนเติม/ซื้อ/โอนจริง)
+    with read_conn() as conn:
         row = conn.execute("SELECT balance_cents FROM users WHERE discord_id=?", (discord_id,)).fetchone()
-        return row["balance_cents"] if row else 0
+    return row["balance_cents"] if row else 0
 
 def add_balance(discord_id: int, cents: int):
-    ensure_user(discord_id)
-    with db() as conn:
+    with write_conn() as conn:
         conn.execute(
-            "UPDATE users SET balance_cents = balance_cents + ? WHERE discord_id=?",
-            (cents, discord_id),
+            "INSERT INTO users (discord_id, balance_cents) VALUES (?,?) "
+            "ON CONFLICT(discord_id) DO UPDATE SET balance_cents = balance_cents + excluded.balance_cents",
+            (discord_id, cents),
         )
-        conn.commit()
+
+# SQL ที่ใช้บ่อยเป็นค่าคงที่: ส่ง string ตัวเดิมทุกครั้ง sqlite3 จะหยิบ statement ที่ prepare ไว้จาก cache
+# รายการที่เปิดขายต้องมีคอลัมน์ครบ เพราะ get_item ใช้ cache นี้ตอนซื้อ/ส่งไฟล์ด้วย
+_SQL_LIST_ACTIVE = "SELECT id, name, price_cents, gdrive_url, filename, is_active FROM items WHERE is_active=1"
+# หน้าแอดมินใช้แค่ id/ชื่อ/ราคา/สถานะ ไม่ต้องดึง gdrive_url มาด้วย
+_SQL_LIST_ALL = "SELECT id, name, price_cents, is_active FROM items"
+_SQL_GET_ITEM = "SELECT id, name, price_cents, gdrive_url, filename, is_active FROM items WHERE id=?"
+
+# cache สินค้าที่เปิดขาย: เปลี่ยนเฉพาะตอนแอดมินแก้ เลยไม่ต้อง query ทุกครั้งที่เปิดเมนู
+# เก็บ (list, dict ตาม id) เป็น tuple เดียว สลับด้วย assignment ครั้งเดียวจึงไม่ต้องล็อก
+_ITEM_CACHE: Optional[Tuple[List[dict], Dict[int, dict]]] = None
+_ITEM_REFILL_LOCK = threading.Lock()
+
+# item_id -> ชื่อ ของสินค้าทุกชิ้น (รวมที่ปิดขาย) ใช้แสดงประวัติการซื้อ: โหลดตอน db_init แล้วแก้ตาม upsert/delete
+_ITEM_NAMES: Dict[int, str] = {}
+
+def _load_item_names():
+    global _ITEM_NAMES
+    with read_conn() as conn:
+        _ITEM_NAMES = {r["id"]: r["name"] for r in conn.execute("SELECT id, name FROM items")}
+
+# เพิ่มทุกครั้งที่ตาราง items เปลี่ยน: ของที่สร้างจากรายการสินค้า (เช่น options ของเมนู) ใช้เช็คว่าเก่าหรือยัง
+_ITEMS_VERSION = 0
+
+def _invalidate_items():
+    global _ITEM_CACHE, _ITEMS_VERSION
+    # ใต้ล็อกเดียวกับการ refill: refill ที่อ่าน DB ก่อนแอดมิน commit จะเขียน snapshot เสร็จก่อน
+    # แล้วค่อยถูกล้างตรงนี้ ไม่ใช่ไปเขียนทับหลังล้าง (ค้างข้อมูลเก่าไว้จนกว่าจะแก้ครั้งถัดไป)
+    # ล้าง cache ก่อนค่อยเพิ่มเวอร์ชัน: ใครเห็นเวอร์ชันใหม่ (เช่น _shop_options ที่อ่านแบบไม่ล็อก)
+    # จะไม่ได้ snapshot เก่าจาก _active_items มาผูกกับเวอร์ชันใหม่
+    with _ITEM_REFILL_LOCK:
+        _ITEM_CACHE = None
+        _ITEMS_VERSION += 1
+    # เรียกจาก helper ที่รันบน _DB_POOL อยู่แล้ว: โหลดใหม่ตรงนี้เลย เมนูบน event loop จะไม่ต้อง query เอง
+    _active_items()
+
+def _active_items() -> Tuple[List[dict], Dict[int, dict]]:
+    global _ITEM_CACHE
+    cache = _ITEM_CACHE
+    if cache is not None:
+        return cache
+    # หลัง invalidate ให้โหลดใหม่แค่ครั้งเดียว คนอื่นที่มาพร้อมกันรอใช้ผลเดียวกัน
+    with _ITEM_REFILL_LOCK:
+        cache = _ITEM_CACHE
+        if cache is None:
+            with read_conn() as conn:
+                rows = [dict(r) for r in conn.execute(_SQL_LIST_ACTIVE).fetchall()]
+            cache = (rows, {r["id"]: r for r in rows})
+            _ITEM_CACHE = cache
+    return cache
 
 def list_items(active_only: bool = True) -> List[sqlite3.Row]:
-    q = "SELECT * FROM items" + (" WHERE is_active=1" if active_only else "")
-    with db() as conn:
-        return list(conn.execute(q).fetchall())
+    if active_only:
+        return _active_items()[0]
+    with read_conn() as conn:
+        return conn.execute(_SQL_LIST_ALL).fetchall()
 
 def get_item(item_id: int) -> Optional[sqlite3.Row]:
-    with db() as conn:
-        return conn.execute("SELECT * FROM items WHERE id=?", (item_id,)).fetchone()
+    item = _active_items()[1].get(item_id)
+    if item is not None:
+        return item
+    with read_conn() as conn:
+        return conn.execute(_SQL_GET_ITEM, (item_id,)).fetchone()
 
 def upsert_item(
     name: str,
@@ -190,58 +467,89 @@ def upsert_item(
     filename: str = "video.mp4",
     item_id: Optional[int] = None,
 ) -> int:
-    with db() as conn:
+    old_url = None
+    with write_conn() as conn:
         cur = conn.cursor()
         if item_id is None:
             cur.execute(
                 "INSERT INTO items (name, price_cents, gdrive_url, filename, is_active) VALUES (?,?,?,?,1)",
                 (name, price_cents, gdrive_url, filename),
             )
-            conn.commit()
-            return cur.lastrowid
+            item_id = cur.lastrowid
         else:
+            row = cur.execute("SELECT gdrive_url FROM items WHERE id=?", (item_id,)).fetchone()
+            if row is not None:
+                old_url = row["gdrive_url"]
             cur.execute(
                 "UPDATE items SET name=?, price_cents=?, gdrive_url=?, filename=? WHERE id=?",
                 (name, price_cents, gdrive_url, filename, item_id),
             )
-            conn.commit()
-            return item_id
+    _invalidate_items()
+    _ITEM_NAMES[item_id] = name
+    _OVERSIZE.pop(_cache_key(gdrive_url), None)
+    # แก้สินค้า = ล้าง cache คลิปของลิงก์ทั้งเก่าและใหม่เสมอ (แม้ลิงก์เดิม): ไฟล์ที่ถูกแทนที่บน Drive
+    # ด้วย id เดิมจะไม่ถูกเสิร์ฟจากดิสก์ต่อ แอดมินแค่กดบันทึกสินค้าซ้ำหลังเปลี่ยนไฟล์
+    if old_url is not None:
+        _cache_drop(old_url)
+        _cache_drop(gdrive_url)
+    return item_id
 
 def delete_item(item_id: int) -> bool:
-    with db() as conn:
-        cur = conn.execute("DELETE FROM items WHERE id=?", (item_id,))
-        conn.commit()
-        return cur.rowcount > 0
+    with write_conn() as conn:
+        row = conn.execute("SELECT gdrive_url FROM items WHERE id=?", (item_id,)).fetchone()
+        conn.execute("DELETE FROM items WHERE id=?", (item_id,))
+    _invalidate_items()
+    _ITEM_NAMES.pop(item_id, None)
+    if row is None:
+        return False
+    _cache_drop(row["gdrive_url"])
+    return True
 
 def set_item_active(item_id: int, active: bool):
-    with db() as conn:
+    with write_conn() as conn:
         conn.execute("UPDATE items SET is_active=? WHERE id=?", (1 if active else 0, item_id))
-        conn.commit()
+    _invalidate_items()
 
-def add_purchase(discord_id: int, item_id: int, price_cents: int):
-    with db() as conn:
-        conn.execute(
-            "INSERT INTO purchases (discord_id, item_id, price_cents, created_at) VALUES (?,?,?,?)",
-            (discord_id, item_id, price_cents, now_utc_iso()),
+PurchaseStatus = Literal["ok", "unavailable", "closed", "insufficient"]
+
+def try_purchase(discord_id: int, item_id: int) -> Tuple[PurchaseStatus, Optional[sqlite3.Row], int]:
+    """
+    เช็คสินค้า + สถานะร้าน + ตัดเงิน + บันทึกการซื้อ ใน transaction เดียว
+    คืน (สถานะ, แถวสินค้า, ยอดคงเหลือหลังซื้อ)
+    """
+    with write_conn() as conn:
+        item = conn.execute(_SQL_GET_ITEM, (item_id,)).fetchone()
+        if not item or not item["is_active"]:
+            return "unavailable", None, 0
+        row = conn.execute("SELECT value FROM settings WHERE key='shop_open'").fetchone()
+        if row is not None and row["value"] != "1":
+            return "closed", item, 0
+
+        price = item["price_cents"]
+        conn.execute("INSERT OR IGNORE INTO users (discord_id) VALUES (?)", (discord_id,))
+        # ตัดเงินแบบมีเงื่อนไข กันกดยืนยันซ้อนแล้วยอดติดลบ
+        cur = conn.execute(
+            "UPDATE users SET balance_cents = balance_cents - ? WHERE discord_id=? AND balance_cents >= ? "
+            "RETURNING balance_cents",
+            (price, discord_id, price),
         )
+        bal = cur.fetchone()
+        if bal is None:
+            return "insufficient", item, 0
         conn.execute(
-            "UPDATE users SET balance_cents = balance_cents - ? WHERE discord_id=?",
-            (price_cents, discord_id),
-        )
-        conn.commit()
-
-def get_my_purchases(discord_id: int, limit: int = 20) -> List[sqlite3.Row]:
-    with db() as conn:
-        return list(
-            conn.execute(
-                """
-                SELECT p.id, p.created_at, p.price_cents, i.name
-                FROM purchases p JOIN items i ON p.item_id=i.id
-                WHERE p.discord_id=? ORDER BY p.id DESC LIMIT ?
-                """,
-                (discord_id, limit),
-            ).fetchall()
+            "INSERT INTO purchases (discord_id, item_id, price_cents, created_at) VALUES (?,?,?,?)",
+            (discord_id, item_id, price, now_ts()),
         )
+        return "ok", item, bal["balance_cents"]
+
+def get_my_purchases(discord_id: int, limit: int = 20) -> List[dict]:
+    # ชื่อสินค้ามาจาก _ITEM_NAMES แทนการ JOIN items; สินค้าที่ถูกลบไปแล้วยังแสดงในประวัติได้
+    with read_conn() as conn:
+        rows = conn.execute(
+            "SELECT id, item_id, created_at, price_cents FROM purchases WHERE discord_id=? ORDER BY id DESC LIMIT ?",
+            (discord_id, limit),
+        ).fetchall()
+    return [{**dict(r), "name": _ITEM_NAMES.get(r["item_id"], "(ลบแล้ว)")} for r in rows]
 
 # ---------- Transfers ----------
 def transfer_balance(from_id: int, to_id: int, amount_cents: int) -> Tuple[bool, str]:
@@ -250,21 +558,23 @@ def transfer_balance(from_id: int, to_id: int, amount_cents: int) -> Tuple[bool,
     if from_id == to_id:
         return False, "ไม่สามารถโอนให้ตัวเองได้"
 
-    ensure_user(from_id)
-    ensure_user(to_id)
-    with db() as conn:
-        row = conn.execute("SELECT balance_cents FROM users WHERE discord_id=?", (from_id,)).fetchone()
-        bal = row["balance_cents"] if row else 0
-        if bal < amount_cents:
+    with write_conn() as conn:
+        # ตัดเงินแบบมีเงื่อนไข: ไม่มีแถวหรือยอดไม่พอ => ไม่มีแถวถูกแก้ (ไม่ต้อง SELECT ก่อน)
+        cur = conn.execute(
+            "UPDATE users SET balance_cents = balance_cents - ? WHERE discord_id=? AND balance_cents >= ?",
+            (amount_cents, from_id, amount_cents),
+        )
+        if cur.rowcount == 0:
             return False, "ยอดเงินไม่พอ"
 
-        conn.execute("UPDATE users SET balance_cents = balance_cents - ? WHERE discord_id=?",
-                     (amount_cents, from_id))
-        conn.execute("UPDATE users SET balance_cents = balance_cents + ? WHERE discord_id=?",
-                     (amount_cents, to_id))
+        # ผู้รับที่ยังไม่มีแถวถูกสร้างพร้อมยอดในคำสั่งเดียว
+        conn.execute(
+            "INSERT INTO users (discord_id, balance_cents) VALUES (?,?) "
+            "ON CONFLICT(discord_id) DO UPDATE SET balance_cents = balance_cents + excluded.balance_cents",
+            (to_id, amount_cents),
+        )
         conn.execute("INSERT INTO transfers (from_id, to_id, amount_cents, created_at) VALUES (?,?,?,?)",
-                     (from_id, to_id, amount_cents, now_utc_iso()))
-        conn.commit()
+                     (from_id, to_id, amount_cents, now_ts()))
     return True, "โอนเงินสำเร็จ"
 
 # ---------- Google Drive helpers ----------
@@ -273,6 +583,8 @@ _GDRIVE_ID_RE = re.compile(r'(?:/d/|id=)([A-Za-z0-9_-]{10,})')
 def _clean_link(s: str) -> str:
     return s.strip().strip('<>').strip('"\'' )
 
+# ฟังก์ชันแปลงลิงก์เป็น pure function และชุดลิงก์มีจำกัดตามตาราง items => memoize ได้เลย
+@lru_cache(maxsize=512)
 def _gdrive_file_id(s: str) -> Optional[str]:
     s = _clean_link(s)
     m = _GDRIVE_ID_RE.search(s)
@@ -282,26 +594,234 @@ def _gdrive_file_id(s: str) -> Optional[str]:
         return s
     return None
 
+@lru_cache(maxsize=512)
 def normalize_gdrive_for_download(url_or_id: str) -> str:
     s = _clean_link(url_or_id)
     fid = _gdrive_file_id(s)
     if fid:
-        return f"https://drive.google.com/uc?id={fid}"
+        return f"https://drive.google.com/uc?export=download&id={fid}"
     return s
 
+_DRIVE_FORM_RE = re.compile(r'<form[^>]*id="download-form"[^>]*action="([^"]+)"')
+_DRIVE_HIDDEN_RE = re.compile(r'<input type="hidden" name="([^"]+)" value="([^"]*)"')
+_DRIVE_CONFIRM_RE = re.compile(r'href="(/uc\?export=download[^"]*confirm=[^"]+)"')
+
+def _drive_confirm_request(page: str) -> Optional[Tuple[str, Optional[Dict[str, str]]]]:
+    # หน้าเตือนของ Drive: แบบใหม่เป็น form (id/export/confirm/uuid) แบบเก่าเป็นลิงก์ที่มี confirm=
+    m = _DRIVE_FORM_RE.search(page)
+    if m:
+        fields = {k: html.unescape(v) for k, v in _DRIVE_HIDDEN_RE.findall(page)}
+        return html.unescape(m.group(1)), fields
+    m = _DRIVE_CONFIRM_RE.search(page)
+    if m:
+        return "https://drive.google.com" + html.unescape(m.group(1)), None
+    return None
+
 # ---------- DOWNLOAD / DELIVERY ----------
-async def download_drive_to_temp(url_or_id: str, filename_hint: str) -> Tuple[str, int]:
-    def _download() -> Tuple[str, int]:
-        tmpdir = tempfile.mkdtemp(prefix="shopclip_")
-        out = os.path.join(
-            tmpdir,
-            filename_hint if filename_hint.endswith(".mp4") else f"{filename_hint}.mp4",
-        )
-        url = normalize_gdrive_for_download(url_or_id)
-        gdown.download(url, out, quiet=True, fuzzy=True)
-        return out, os.path.getsize(out)
+# จำกัดจำนวนงานดาวน์โหลดพร้อมกัน กัน RAM บวม/โดน Drive rate limit ตอนคนซื้อพร้อมกันเยอะๆ
+DOWNLOAD_WORKERS = 4
+DOWNLOAD_CHUNK = 1 << 16
+_DL_SEM = asyncio.Semaphore(DOWNLOAD_WORKERS)
+_HTTP: Optional[aiohttp.ClientSession] = None
+
+def _http() -> aiohttp.ClientSession:
+    global _HTTP
+    if _HTTP is None or _HTTP.closed:
+        _HTTP = aiohttp.ClientSession()
+    return _HTTP
+
+# ---- cache คลิปบนดิสก์ตาม file id ของ Drive (LRU จำกัดขนาดรวม) คนซื้อซ้ำไม่ต้องโหลดจาก Drive ใหม่ ----
+# แก้ลิงก์ของสินค้าเป็นไฟล์อื่น = key ใหม่ (และ upsert_item ลบไฟล์เก่าทิ้ง) จึงไม่มีทางได้ไฟล์เก่าผิดตัว
+CLIP_CACHE_DIR = os.getenv("CLIP_CACHE_DIR", os.path.join(tempfile.gettempdir(), "shopclip_cache"))
+# ไฟล์ cache อยู่ในโฟลเดอร์ย่อยที่บอทสร้างเอง: CLIP_CACHE_DIR อาจเป็นดิสก์ที่ใช้ร่วมกับอย่างอื่น (เช่น DB_PATH)
+_CLIP_DIR = os.path.join(CLIP_CACHE_DIR, "clips")
+CLIP_CACHE_MAX_BYTES = int(os.getenv("CLIP_CACHE_MAX_BYTES", str(2 * 1024 * 1024 * 1024)))
+_CLIP_CACHE: "OrderedDict[str, int]" = OrderedDict()  # key -> size (เก่าสุดอยู่หน้า)
+_CLIP_CACHE_LOCK = threading.Lock()
+_clip_cache_loaded = False
+
+_CACHE_KEY_RE = re.compile(r'[A-Za-z0-9_-]{10,}')
+
+def _cache_key(gdrive_url: str) -> str:
+    # ใช้ file id ของ Drive: ลิงก์ต่างรูปแบบ (/file/d/.../view, uc?id=...) ของไฟล์เดียวกันใช้ cache ร่วมกัน
+    # ลิงก์ที่ไม่ใช่ Drive ใช้ sha1 ของลิงก์แทน
+    return _gdrive_file_id(gdrive_url) or hashlib.sha1(gdrive_url.encode()).hexdigest()
+
+def _cache_path(key: str) -> str:
+    return os.path.join(_CLIP_DIR, f"{key}.mp4")
+
+def _cache_load():
+    # เก็บไฟล์ที่ค้างจากรอบก่อนเข้า index ด้วย เพื่อให้นับขนาดรวมถูกต้อง
+    global _clip_cache_loaded
+    if _clip_cache_loaded:
+        return
+    os.makedirs(_CLIP_DIR, exist_ok=True)
+    entries = []
+    for name in os.listdir(_CLIP_DIR):
+        stem, ext = os.path.splitext(name)
+        path = os.path.join(_CLIP_DIR, name)
+        if ext == ".mp4" and _CACHE_KEY_RE.fullmatch(stem):
+            st = os.stat(path)
+            entries.append((st.st_atime, stem, st.st_size))
+        elif ext == ".part":
+            # เขียนค้างจากรอบก่อน (โปรเซสตายกลางทาง) ไฟล์อื่นไม่ใช่ของเรา ไม่ยุ่ง
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+    for _, key, size in sorted(entries):
+        _CLIP_CACHE[key] = size
+    _clip_cache_loaded = True
+
+def _cache_get(key: str) -> Optional[Tuple[str, int]]:
+    with _CLIP_CACHE_LOCK:
+        _cache_load()
+        size = _CLIP_CACHE.get(key)
+        if size is None:
+            return None
+        _CLIP_CACHE.move_to_end(key)
+    return _cache_path(key), size
+
+def _cache_put(key: str, data: Union[bytes, memoryview]):
+    # เขียนลงชื่อไฟล์ชั่วคราวที่ไม่ซ้ำในโฟลเดอร์เดียวกันแล้ว rename ทับ (atomic)
+    # คนที่กำลังอัปโหลดไฟล์เดิมอยู่จะไม่เจอไฟล์ที่เขียนได้ครึ่งเดียว
+    try:
+        with _CLIP_CACHE_LOCK:
+            _cache_load()
+        tmp = os.path.join(_CLIP_DIR, f"{key}-{uuid.uuid4().hex}.part")
+        try:
+            with open(tmp, "wb") as f:
+                f.write(data)
+            os.replace(tmp, _cache_path(key))
+        except OSError:
+            try:
+                os.unlink(tmp)
+            except OSError:
+                pass
+            raise
+        with _CLIP_CACHE_LOCK:
+            _CLIP_CACHE[key] = len(data)
+            _CLIP_CACHE.move_to_end(key)
+            total = sum(_CLIP_CACHE.values())
+            while total > CLIP_CACHE_MAX_BYTES and len(_CLIP_CACHE) > 1:
+                old_key, old_size = _CLIP_CACHE.popitem(last=False)
+                total -= old_size
+                try:
+                    os.unlink(_cache_path(old_key))
+                except OSError:
+                    pass
+    except OSError as e:
+        print("[cache] write failed:", e)
+
+def _cache_put_buffer(key: str, buf: io.BytesIO):
+    # เขียนจาก buffer ของ BytesIO ตรง ๆ (memoryview อ่านอย่างเดียว) ไม่ copy ทั้งคลิปเป็นอีกก้อน
+    # ระหว่างที่ตัวเดิมยังถูกอัปโหลดอยู่ (คลิปใหญ่ได้ถึงลิมิตของกิลด์)
+    with buf.getbuffer() as view:
+        _cache_put(key, view)
+
+def _cache_drop(gdrive_url: str):
+    key = _cache_key(gdrive_url)
+    with _CLIP_CACHE_LOCK:
+        _CLIP_CACHE.pop(key, None)
+        try:
+            os.unlink(_cache_path(key))
+        except OSError:
+            pass
+
+# ไฟล์ (ตาม _cache_key) ที่เคยเจอว่าใหญ่เกินลิมิต (ขนาดจาก Content-Length หรืออย่างน้อยเท่าที่อ่านได้)
+# คนซื้อรอบถัดไปจะได้คำตอบทันทีโดยไม่ต้องยิง Drive ซ้ำ
+_OVERSIZE: Dict[str, int] = {}
+
+async def download_drive(
+    url_or_id: str,
+    limit: int = MAX_UPLOAD_BYTES,
+) -> Tuple[Optional[Union[str, io.BytesIO]], int]:
+    """
+    คืน path จาก cache ถ้าเคยโหลดแล้ว ไม่งั้นสตรีมไฟล์จาก Drive เข้าหน่วยความจำโดยตรง (ไม่ผ่านดิสก์)
+    คืน (None, จำนวนไบต์ที่อ่านได้) ทันทีที่เกิน limit
+    """
+    key = _cache_key(url_or_id)
+    hit = _cache_get(key)
+    if hit is not None:
+        path, size = hit
+        return (path if size <= limit else None), size
+    known = _OVERSIZE.get(key)
+    if known is not None and known > limit:
+        return None, known
+
+    async def _fetch() -> Tuple[Optional[io.BytesIO], int]:
+        url, params = normalize_gdrive_for_download(url_or_id), None
+        # ไฟล์ใหญ่ Drive จะตอบหน้า "ไม่สามารถสแกนไวรัสได้" ก่อน => ยืนยันแล้วขอใหม่อีกรอบเดียว
+        for _ in range(2):
+            async with _http().get(url, params=params) as resp:
+                resp.raise_for_status()
+                if resp.content_type == "text/html":
+                    confirm = _drive_confirm_request(await resp.text())
+                    if confirm is None:
+                        break
+                    url, params = confirm
+                    continue
+                # รู้ขนาดจาก header แล้วเกินลิมิต => ไม่ต้องโหลด body เลย
+                if resp.content_length is not None and resp.content_length > limit:
+                    return None, resp.content_length
+                buf = io.BytesIO()
+                async for chunk in resp.content.iter_chunked(DOWNLOAD_CHUNK):
+                    buf.write(chunk)
+                    if buf.tell() > limit:
+                        return None, buf.tell()
+                buf.seek(0)
+                return buf, buf.getbuffer().nbytes
+        raise RuntimeError("ลิงก์นี้ไม่ได้เปิดให้ดาวน์โหลดไฟล์โดยตรง")
+
+    async with _DL_SEM:
+        buf, size = await asyncio.wait_for(_fetch(), timeout=120)
+    if buf is None:
+        _OVERSIZE[key] = size
+    else:
+        asyncio.get_running_loop().run_in_executor(None, _cache_put_buffer, key, buf)
+    return buf, size
+
+# ตอนบูต: โหลดไฟล์ของสินค้าที่เปิดขายเข้า cache ล่วงหน้า (ทีละ 2 ไฟล์ กัน Drive จำกัด rate)
+_PREFETCH_SEM = asyncio.Semaphore(2)
+
+async def _prefetch(url: str):
+    async with _PREFETCH_SEM:
+        try:
+            await download_drive(url)
+        except Exception as e:
+            print("[prefetch] failed:", e)
+
+async def prefetch_active_items():
+    items = await _run_db(list_items, active_only=True)
+    urls = {_cache_key(r["gdrive_url"]): r["gdrive_url"] for r in items}
+    await asyncio.gather(*(_prefetch(url) for url in urls.values()))
+    print(f"[prefetch] warmed {len(urls)} item(s)")
+
+def _upload_limit(guild: Optional[discord.Guild]) -> int:
+    # กิลด์ที่บูสต์แล้วอัปโหลดได้ใหญ่กว่า (50/100MB) ส่วน DM ใช้ลิมิตพื้นฐาน
+    if guild is None:
+        return MAX_UPLOAD_BYTES
+    return max(MAX_UPLOAD_BYTES, guild.filesize_limit)
 
-    return await asyncio.wait_for(asyncio.to_thread(_download), timeout=120)
+# ห้องที่หาเจอแล้ว (รวมที่ต้อง fetch ผ่าน HTTP) เก็บไว้ตลอดอายุโปรเซส ลบออกเมื่อห้องถูกลบ
+_CHANNEL_CACHE: Dict[int, discord.abc.Messageable] = {}
+
+async def _get_channel(channel_id: int) -> Optional[discord.abc.Messageable]:
+    ch = _CHANNEL_CACHE.get(channel_id) or bot.get_channel(channel_id)
+    if ch is None:
+        try:
+            ch = await bot.fetch_channel(channel_id)
+        except Exception:
+            return None
+    _CHANNEL_CACHE[channel_id] = ch
+    return ch
+
+async def _resolve_target(user: discord.User, guild: Optional[discord.Guild]) -> discord.abc.Messageable:
+    if guild and SEND_CHANNEL_ID > 0:
+        ch = await _get_channel(SEND_CHANNEL_ID)
+        if ch:
+            return ch
+    return await user.create_dm()
 
 async def deliver_file(
     *,
@@ -315,36 +835,76 @@ async def deliver_file(
     ส่งไฟล์ไปที่:
      - ถ้ามี SEND_CHANNEL_ID (>0 และเจอห้อง) => ส่งในห้องนั้น
      - ไม่งั้นส่งทาง DM
+    หาห้อง/เปิด DM พร้อมกับดาวน์โหลดไฟล์ ไม่ต้องรอกันทีละขั้น
     """
-    target = None
-    if guild and SEND_CHANNEL_ID > 0:
-        ch = guild.get_channel(SEND_CHANNEL_ID) or bot.get_channel(SEND_CHANNEL_ID)
-        if ch is None:
-            try:
-                ch = await bot.fetch_channel(SEND_CHANNEL_ID)
-            except Exception:
-                ch = None
-        if ch:
-            target = ch
-
-    if target is None:
-        target = await user.create_dm()
-
-    clean_link = normalize_gdrive_for_download(gdrive_url)
+    filename = filename or "video.mp4"
+    if not filename.endswith(".mp4"):
+        filename = f"{filename}.mp4"
 
+    # ดาวน์โหลดตามลิมิตของกิลด์ไว้ก่อน แล้วค่อยเช็คกับปลายทางจริง (อาจ fallback เป็น DM)
     try:
-        path, size = await download_drive_to_temp(clean_link, filename or "video.mp4")
-        if size <= MAX_UPLOAD_BYTES:
-            await target.send(content=f"ส่งคลิป **{item_name}** ให้แล้วครับ 🎬", file=discord.File(path))
-            return True, ""
-        else:
-            return False, f"ไฟล์ {item_name} ขนาด {size/1024/1024:.1f}MB เกินลิมิตอัปโหลดของ Discord"
-    except asyncio.TimeoutError:
-        return False, "การเตรียมไฟล์ใช้เวลานานเกินกำหนด"
+        async with asyncio.TaskGroup() as tg:
+            target_task = tg.create_task(_resolve_target(user, guild))
+            dl_task = tg.create_task(download_drive(gdrive_url, limit=_upload_limit(guild)))
+    except BaseExceptionGroup as eg:
+        err = eg.exceptions[0]
+        if isinstance(err, asyncio.TimeoutError):
+            return False, "การเตรียมไฟล์ใช้เวลานานเกินกำหนด"
+        return False, f"เกิดข้อผิดพลาดระหว่างดาวน์โหลด: {err}"
+
+    target = target_task.result()
+    src, size = dl_task.result()
+    limit = _upload_limit(getattr(target, "guild", None))
+    if src is None or size > limit:
+        return False, f"ไฟล์ {item_name} ขนาดเกิน {limit/1024/1024:.0f}MB ซึ่งเป็นลิมิตอัปโหลดของ Discord"
+    try:
+        await target.send(
+            content=f"ส่งคลิป **{item_name}** ให้แล้วครับ 🎬",
+            file=discord.File(src, filename=filename),
+        )
+        return True, ""
     except Exception as e:
-        return False, f"เกิดข้อผิดพลาดระหว่างดาวน์โหลด: {e}"
+        return False, f"เกิดข้อผิดพลาดระหว่างส่งไฟล์: {e}"
 
 # ---------- Logging helpers ----------
+# log ส่งผ่านคิวต่อห้อง: ข้อความที่มาติด ๆ กันภายใน LOG_FLUSH_DELAY รวมเป็นข้อความเดียว (ลดจำนวน HTTP)
+# และ handler ไม่ต้องรอ Discord ตอบก่อนทำงานต่อ
+LOG_FLUSH_DELAY = 0.5
+MESSAGE_MAX_LEN = 2000
+_LOG_QUEUES: Dict[int, asyncio.Queue] = {}
+_LOG_WORKERS: Dict[int, asyncio.Task] = {}
+
+def _pack_lines(lines: List[str]) -> List[str]:
+    # รวมบรรทัดเป็นก้อนละไม่เกิน MESSAGE_MAX_LEN ตัวอักษร (บรรทัดที่ยาวเกินเองถูกตัด)
+    chunks: List[str] = []
+    cur = ""
+    for line in lines:
+        line = line[:MESSAGE_MAX_LEN]
+        if cur and len(cur) + 1 + len(line) > MESSAGE_MAX_LEN:
+            chunks.append(cur)
+            cur = line
+        else:
+            cur = f"{cur}\n{line}" if cur else line
+    if cur:
+        chunks.append(cur)
+    return chunks
+
+async def _log_worker(channel_id: int, q: asyncio.Queue):
+    while True:
+        lines = [await q.get()]
+        await asyncio.sleep(LOG_FLUSH_DELAY)
+        while not q.empty():
+            lines.append(q.get_nowait())
+
+        ch = await _get_channel(channel_id)
+        if ch is None:
+            continue
+        for chunk in _pack_lines(lines):
+            try:
+                await ch.send(chunk)
+            except Exception:
+                pass
+
 async def log_by_fixed_ids(guild: Optional[discord.Guild], *, kind: str, text: str):
     if guild is None:
         return
@@ -358,36 +918,43 @@ async def log_by_fixed_ids(guild: Optional[discord.Guild], *, kind: str, text: s
     if channel_id <= 0:
         return
 
-    ch = guild.get_channel(channel_id) or bot.get_channel(channel_id)
-    if ch is None:
-        try:
-            ch = await bot.fetch_channel(channel_id)
-        except Exception:
-            ch = None
-    if ch:
-        try:
-            await ch.send(text)
-        except Exception:
-            pass
+    q = _LOG_QUEUES.get(channel_id)
+    if q is None:
+        q = _LOG_QUEUES[channel_id] = asyncio.Queue()
+        _LOG_WORKERS[channel_id] = asyncio.create_task(_log_worker(channel_id, q))
+    q.put_nowait(text)
 
 # ---------- UI ----------
+# SelectOption ของเมนูสร้างครั้งเดียวต่อ _ITEMS_VERSION: รายการไม่เปลี่ยน => ไม่แตะ item cache/DB เลย
+_OPTIONS_CACHE: Tuple[int, List[discord.SelectOption]] = (-1, [])
+
+def _shop_options() -> List[discord.SelectOption]:
+    global _OPTIONS_CACHE
+    version, options = _OPTIONS_CACHE
+    if version == _ITEMS_VERSION:
+        return options
+    # อ่านเวอร์ชันก่อนโหลด: ถ้ามีการแก้ระหว่างทาง รอบหน้าจะสร้างใหม่อีกครั้ง
+    version = _ITEMS_VERSION
+    options = [
+        discord.SelectOption(
+            label=r["name"][:100],
+            value=str(r["id"]),
+            description=f"ราคา {fmt_thb(r['price_cents'])}",
+        )
+        for r in list_items(active_only=True)
+    ]
+    _OPTIONS_CACHE = (version, options)
+    return options
+
 class ShopSelect(Select):
     def __init__(self):
-        rows = list_items(active_only=True)
-        if not rows:
+        options = _shop_options()
+        if not options:
             super().__init__(placeholder="ยังไม่มีรายการจำหน่าย", options=[], disabled=True)
             return
 
-        options = []
-        for r in rows:
-            options.append(
-                discord.SelectOption(
-                    label=r["name"][:100],
-                    value=str(r["id"]),
-                    description=f"ราคา {fmt_thb(r['price_cents'])}",
-                )
-            )
-        super().__init__(placeholder="เลือกรายการทั้งหมด", min_values=1, max_values=1, options=options, custom_id='shop:select')
+        # copy list เพราะ discord.py อาจแก้ options ของ component เอง
+        super().__init__(placeholder="เลือกรายการทั้งหมด", min_values=1, max_values=1, options=list(options), custom_id='shop:select')
 
     async def callback(self, interaction: Interaction):
         await interaction.response.defer(ephemeral=True)
@@ -395,12 +962,13 @@ class ShopSelect(Select):
             return await interaction.followup.send("ตอนนี้ร้านปิดชั่วคราว ⛔ กรุณามาใหม่ภายหลัง", ephemeral=True)
 
         item_id = int(self.values[0])
-        item = get_item(item_id)
+        # สินค้าที่ปิดขายไปแล้วแต่ยังค้างในเมนูเก่าไม่อยู่ใน cache => ต้อง query จึงให้ไปรันบน pool
+        item = await _run_db(get_item, item_id)
         if not item or not item["is_active"]:
             return await interaction.followup.send("รายการนี้ไม่พร้อมจำหน่ายแล้วครับ", ephemeral=True)
 
         price = item["price_cents"]
-        bal = get_balance(interaction.user.id)
+        bal = await _run_db(get_balance, interaction.user.id)
         if bal < price:
             need = price - bal
             return await interaction.followup.send(
@@ -416,39 +984,80 @@ class ShopSelect(Select):
             ephemeral=True,
         )
 
+# ล็อกต่อผู้ใช้: กดยืนยันซ้ำระหว่างที่ยังซื้อ/ส่งไฟล์ไม่เสร็จจะไม่ถูกตัดเงินหรือดาวน์โหลดซ้ำ
+_USER_LOCKS: DefaultDict[int, asyncio.Lock] = defaultdict(asyncio.Lock)
+
+_DELIVERY_OPTIONS = (
+    ("ส่งไฟล์ทาง DM", "dm"),
+    ("ส่งไฟล์ในห้องที่กำหนด", "channel"),
+)
+
+class DeliverySelect(Select):
+    # component เดียวแทนปุ่มแยกตามปลายทาง ส่งต่อให้ ConfirmBuyView._handle
+    # ไม่กำหนด custom_id: view ยืนยันส่งผ่าน followup (ไม่มี message_id) ถ้า id ซ้ำกันทุกคน
+    # discord.py จะเก็บทุก view ไว้ใต้ key เดียว คนหนึ่งกดเสร็จ/หมดเวลาแล้ว view ของคนอื่นหลุดไปด้วย
+    def __init__(self):
+        options = [discord.SelectOption(label=label, value=value) for label, value in _DELIVERY_OPTIONS]
+        super().__init__(placeholder="เลือกรูปแบบการส่ง", min_values=1, max_values=1, options=options)
+
+    async def callback(self, interaction: Interaction):
+        await self.view._handle(interaction, self.values[0])
+
 class ConfirmBuyView(View):
     def __init__(self, item_id: int):
-        super().__init__(timeout=None)
+        # ข้อความยืนยันเป็น ephemeral ไม่ต้องอยู่ถาวร: หมดเวลาแล้วปล่อยให้ GC เก็บได้
+        super().__init__(timeout=120)
         self.item_id = item_id
+        self.add_item(DeliverySelect())
 
-    async def _handle(self, interaction: Interaction, dest: Literal["dm", "channel"]):
-        item = get_item(self.item_id)
-        if not item or not item["is_active"]:
-            return await interaction.response.edit_message(content="รายการนี้ไม่พร้อมจำหน่ายแล้วครับ", view=None)
+    async def on_timeout(self):
+        self.clear_items()
 
-        if get_setting("shop_open", "1") != "1":
-            return await interaction.response.edit_message(content="ตอนนี้ร้านปิดชั่วคราว ⛔", view=None)
+    async def _handle(self, interaction: Interaction, dest: Literal["dm", "channel"]):
+        lock = _USER_LOCKS[interaction.user.id]
+        if lock.locked():
+            return await interaction.response.send_message(
+                "กำลังดำเนินการคำสั่งซื้อก่อนหน้าอยู่ กรุณารอสักครู่ ⏳", ephemeral=True
+            )
+        async with lock:
+            try:
+                await self._purchase(interaction, dest)
+            finally:
+                # _purchase เอา view ออกจากข้อความแล้ว (view=None) หยุดรอ event และตัดอ้างอิง component ทิ้ง
+                self.stop()
+                self.clear_items()
+
+    async def _purchase(self, interaction: Interaction, dest: Literal["dm", "channel"]):
+        # ตอบ Discord ก่อน (ภายใน 3 วิ) แล้วค่อยตัดเงิน: ถ้าตอบไม่ทัน/ล้มเหลว จะไม่มีการตัดเงินค้างไว้
+        await interaction.response.edit_message(content="กำลังดำเนินการ... ⏳", view=None)
+
+        status, item, bal = await _run_db(try_purchase, interaction.user.id, self.item_id)
+        if status == "unavailable":
+            return await interaction.edit_original_response(content="รายการนี้ไม่พร้อมจำหน่ายแล้วครับ")
+        if status == "closed":
+            return await interaction.edit_original_response(content="ตอนนี้ร้านปิดชั่วคราว ⛔")
+        if status == "insufficient":
+            return await interaction.edit_original_response(content="ยอดเงินไม่พอ")
 
         price = item["price_cents"]
-        bal = get_balance(interaction.user.id)
-        if bal < price:
-            return await interaction.response.edit_message(content="ยอดเงินไม่พอ", view=None)
-
-        await interaction.response.edit_message(content="กำลังเตรียมไฟล์ให้คุณ... ⏳", view=None)
-        add_purchase(interaction.user.id, item["id"], price)
-
-        # หากเลือกส่ง "ในห้อง" ให้บังคับใช้ห้องที่กำหนดด้วย SEND_CHANNEL_ID
-        # ถ้าไม่ได้ตั้งค่า หรือหาไม่เจอ จะ fallback เป็น DM อัตโนมัติ
-        ok, err = await deliver_file(
-            user=interaction.user,
-            item_name=item["name"],
-            gdrive_url=item["gdrive_url"],
-            filename=item["filename"] or "video.mp4",
-            guild=interaction.guild if dest == "channel" else None,
-        )
+
+        # ตัดเงินแล้ว: ทุกอย่างจากนี้ถ้าพัง ต้องคืนเงิน
+        try:
+            await interaction.edit_original_response(content="กำลังเตรียมไฟล์ให้คุณ... ⏳")
+            # หากเลือกส่ง "ในห้อง" ให้บังคับใช้ห้องที่กำหนดด้วย SEND_CHANNEL_ID
+            # ถ้าไม่ได้ตั้งค่า หรือหาไม่เจอ จะ fallback เป็น DM อัตโนมัติ
+            ok, err = await deliver_file(
+                user=interaction.user,
+                item_name=item["name"],
+                gdrive_url=item["gdrive_url"],
+                filename=item["filename"] or "video.mp4",
+                guild=interaction.guild if dest == "channel" else None,
+            )
+        except Exception as e:
+            ok, err = False, f"เกิดข้อผิดพลาด: {e}"
 
         if not ok:
-            add_balance(interaction.user.id, price)
+            await _run_db(add_balance, interaction.user.id, price)
             where_txt = "ในห้องที่กำหนด" if dest == "channel" else "ทาง DM"
             return await interaction.followup.send(
                 f"ขออภัย ส่งไฟล์ไม่สำเร็จ ({err}) ❌\n"
@@ -461,7 +1070,7 @@ class ConfirmBuyView(View):
         await interaction.followup.send(
             f"ซื้อ **{item['name']}** เสร็จสิ้น ✅ | ราคา {fmt_thb(price)}\n"
             f"ได้ทำการส่งไฟล์ {where_txt} แล้วครับ 🎬\n"
-            f"ยอดคงเหลือ: {fmt_thb(get_balance(interaction.user.id))}",
+            f"ยอดคงเหลือ: {fmt_thb(bal)}",
             ephemeral=True,
         )
 
@@ -472,13 +1081,6 @@ class ConfirmBuyView(View):
                 text=f"🛒 **Purchase** by {interaction.user.mention} | Item: **{item['name']}** | Price: {fmt_thb(price)} | {now_utc_iso()}",
             )
 
-    @discord.ui.button(label="ส่งไฟล์ทาง DM", style=discord.ButtonStyle.success, custom_id='shop:file_dm')
-    async def file_dm(self, interaction: Interaction, button: Button):
-        await self._handle(interaction, "dm")
-
-    @discord.ui.button(label="ส่งไฟล์ในห้องที่กำหนด", style=discord.ButtonStyle.success, custom_id='shop:file_chan')
-    async def file_chan(self, interaction: Interaction, button: Button):
-        await self._handle(interaction, "channel")
 
 # ---- Modal สำหรับโอนเงิน ----
 class TransferModal(Modal, title="โอนเงินให้ผู้ใช้"):
@@ -502,9 +1104,9 @@ class TransferModal(Modal, title="โอนเงินให้ผู้ใช
         if amount_thb <= 0:
             return await interaction.response.send_message("จำนวนเงินต้องมากกว่า 0", ephemeral=True)
 
-        ok, msg = transfer_balance(interaction.user.id, to_id, to_satang(amount_thb))
+        ok, msg = await _run_db(transfer_balance, interaction.user.id, to_id, to_satang(amount_thb))
         if ok:
-            bal = fmt_thb(get_balance(interaction.user.id))
+            bal = fmt_thb(await _run_db(get_balance, interaction.user.id))
             try:
                 target_user = await interaction.client.fetch_user(to_id)
                 to_display = target_user.mention
@@ -534,53 +1136,54 @@ class MenuView(View):
 
     @discord.ui.button(emoji="💰", label="เช็คยอดเงิน", style=discord.ButtonStyle.secondary, custom_id='shop:balance')
     async def balance_btn(self, interaction: Interaction, button: Button):
+        bal = await _run_db(get_balance, interaction.user.id)
         await interaction.response.send_message(
-            f"ยอดคงเหลือของคุณ: **{fmt_thb(get_balance(interaction.user.id))}**",
+            f"ยอดคงเหลือของคุณ: **{fmt_thb(bal)}**",
             ephemeral=True,
         )
 
     @discord.ui.button(emoji="🧾", label="ประวัติการซื้อ", style=discord.ButtonStyle.secondary, custom_id='shop:history')
     async def history_btn(self, interaction: Interaction, button: Button):
-        rows = get_my_purchases(interaction.user.id, limit=20)
+        rows = await _run_db(get_my_purchases, interaction.user.id, limit=20)
         if not rows:
             return await interaction.response.send_message("ยังไม่มีประวัติการซื้อครับ", ephemeral=True)
-        lines = [f"- {r['name']} | {fmt_thb(r['price_cents'])} | {r['created_at']}" for r in rows]
-        await interaction.response.send_message("ประวัติการซื้อ 20 รายการล่าสุด:\n" + "\n".join(lines), ephemeral=True)
+        await interaction.response.send_message("ประวัติการซื้อ 20 รายการล่าสุด:\n" + fmt_history(rows), ephemeral=True)
 
     @discord.ui.button(emoji="🤝", label="โอนเงิน", style=discord.ButtonStyle.primary, custom_id='shop:transfer')
     async def transfer_btn(self, interaction: Interaction, button: Button):
         await interaction.response.send_modal(TransferModal(opener_id=interaction.user.id))
 
 # ---------- Slash Commands: user ----------
-@bot.tree.command(name="menu", description="เปิดเมนูร้าน (สาธารณะ)")
-async def menu_cmd(interaction: Interaction):
-    is_open = get_setting("shop_open", "1") == "1"
+# embed ของเมนูขึ้นกับสถานะร้านอย่างเดียว (รายการสินค้าอยู่ใน view) => มีแค่ 2 แบบ สร้างครั้งเดียวพอ
+@lru_cache(maxsize=2)
+def _menu_embed(is_open: bool) -> discord.Embed:
     title = "[ ร้านเปิดให้บริการ ]" if is_open else "[ ร้านปิดชั่วคราว ]"
     desc = "เลือกจากเมนูด้านล่างได้เลยครับ" if is_open else "ยังไม่เปิดขายในตอนนี้"
-    embed = discord.Embed(title=title, description=desc, color=discord.Color.blurple())
+    return discord.Embed(title=title, description=desc, color=discord.Color.blurple())
+
+@bot.tree.command(name="menu", description="เปิดเมนูร้าน (สาธารณะ)")
+async def menu_cmd(interaction: Interaction):
+    embed = _menu_embed(get_setting("shop_open", "1") == "1")
     await interaction.response.send_message(embed=embed, view=MenuView(), ephemeral=False)
 
 @bot.tree.command(name="menu_private", description="เปิดเมนูร้าน (เห็นคนเดียว)")
 async def menu_private_cmd(interaction: Interaction):
-    is_open = get_setting("shop_open", "1") == "1"
-    title = "[ ร้านเปิดให้บริการ ]" if is_open else "[ ร้านปิดชั่วคราว ]"
-    desc = "เลือกจากเมนูด้านล่างได้เลยครับ" if is_open else "ยังไม่เปิดขายในตอนนี้"
-    embed = discord.Embed(title=title, description=desc, color=discord.Color.blurple())
+    embed = _menu_embed(get_setting("shop_open", "1") == "1")
     await interaction.response.send_message(embed=embed, view=MenuView(), ephemeral=True)
 
 @bot.tree.command(name="balance", description="เช็คยอดเงินของฉัน")
 async def balance_cmd(interaction: Interaction):
+    bal = await _run_db(get_balance, interaction.user.id)
     await interaction.response.send_message(
-        f"ยอดคงเหลือของคุณ: **{fmt_thb(get_balance(interaction.user.id))}**", ephemeral=True
+        f"ยอดคงเหลือของคุณ: **{fmt_thb(bal)}**", ephemeral=True
     )
 
 @bot.tree.command(name="history", description="ดูประวัติการซื้อของฉัน")
 async def history_cmd(interaction: Interaction):
-    rows = get_my_purchases(interaction.user.id, limit=50)
+    rows = await _run_db(get_my_purchases, interaction.user.id, limit=50)
     if not rows:
         return await interaction.response.send_message("ยังไม่มีประวัติการซื้อครับ", ephemeral=True)
-    lines = [f"- {r['name']} | {fmt_thb(r['price_cents'])} | {r['created_at']}" for r in rows]
-    await interaction.response.send_message("ประวัติของคุณ:\n" + "\n".join(lines), ephemeral=True)
+    await interaction.response.send_message("ประวัติของคุณ:\n" + fmt_history(rows), ephemeral=True)
 
 @bot.tree.command(name="transfer", description="โอนเงินให้ผู้ใช้อื่น")
 @app_commands.describe(user="ผู้รับ", amount_thb="จำนวนเงิน (บาท)")
@@ -590,11 +1193,12 @@ async def transfer_cmd(interaction: Interaction, user: discord.User, amount_thb:
     if user.id == interaction.user.id:
         return await interaction.response.send_message("ไม่สามารถโอนให้ตัวเองได้", ephemeral=True)
 
-    ok, msg = transfer_balance(interaction.user.id, user.id, to_satang(amount_thb))
+    ok, msg = await _run_db(transfer_balance, interaction.user.id, user.id, to_satang(amount_thb))
     if ok:
+        bal = await _run_db(get_balance, interaction.user.id)
         await interaction.response.send_message(
             f"โอนเงินสำเร็จ ✅ จำนวน {amount_thb:.2f} บาท ให้ {user.mention}\n"
-            f"ยอดคงเหลือของคุณ: {fmt_thb(get_balance(interaction.user.id))}",
+            f"ยอดคงเหลือของคุณ: {fmt_thb(bal)}",
             ephemeral=True
         )
         if interaction.guild:
@@ -614,28 +1218,55 @@ async def ping_cmd(interaction: Interaction):
 def require_admin(inter: Interaction) -> Optional[str]:
     return None if is_admin(inter) else "ต้องเป็นแอดมินเท่านั้น"
 
+def admin_only(fn):
+    # ใส่ใต้ @bot.tree.command: เช็คสิทธิ์แอดมินก่อนเข้า handler (wraps ให้ discord.py อ่าน signature เดิมได้)
+    @wraps(fn)
+    async def wrapper(interaction: Interaction, *args, **kwargs):
+        msg = require_admin(interaction)
+        if msg:
+            return await interaction.response.send_message(msg, ephemeral=True)
+        return await fn(interaction, *args, **kwargs)
+    return wrapper
+
+# รายชื่อแอดมินจากตาราง admins: เก็บในหน่วยความจำ แก้ตาม grant/revoke และโหลดใหม่ทุก 30 วิ (เช็คสิทธิ์ไม่ต้องแตะ DB)
+_ADMIN_SET: Set[int] = set()
+_ADMIN_TTL = 30.0
+_admin_loaded_at = 0.0
+# เหมือน settings: โหลดใหม่กับ grant/revoke ต้องไม่สลับ snapshot เก่าทับการแก้ที่เพิ่ง commit
+_ADMIN_LOCK = threading.Lock()
+
+def _load_admins():
+    global _ADMIN_SET, _admin_loaded_at
+    with _ADMIN_LOCK:
+        with read_conn() as conn:
+            # สลับทั้งชุดด้วย assignment เดียว คนที่เช็คสิทธิ์พร้อมกันจะไม่เห็นเซ็ตว่างกลางทาง
+            _ADMIN_SET = {r["discord_id"] for r in conn.execute("SELECT discord_id FROM admins")}
+        _admin_loaded_at = time.monotonic()
+
 def is_admin_user(user_id: int) -> bool:
     if user_id in ADMIN_ENV_IDS:
         return True
-    with db() as conn:
-        row = conn.execute("SELECT 1 FROM admins WHERE discord_id=?", (user_id,)).fetchone()
-        if row:
-            return True
-    return False
+    global _admin_loaded_at
+    if time.monotonic() - _admin_loaded_at > _ADMIN_TTL:
+        _admin_loaded_at = time.monotonic()
+        _reload_in_background(_load_admins)
+    return user_id in _ADMIN_SET
 
 def is_admin(inter: Interaction) -> bool:
     guild_owner_ok = inter.guild is not None and inter.user.id == inter.guild.owner_id
     return guild_owner_ok or is_admin_user(inter.user.id)
 
 def grant_admin(user_id: int):
-    with db() as conn:
+    with write_conn() as conn:
         conn.execute("INSERT OR IGNORE INTO admins (discord_id) VALUES (?)", (user_id,))
-        conn.commit()
+    with _ADMIN_LOCK:
+        _ADMIN_SET.add(user_id)
 
 def revoke_admin(user_id: int):
-    with db() as conn:
+    with write_conn() as conn:
         conn.execute("DELETE FROM admins WHERE discord_id=?", (user_id,))
-        conn.commit()
+    with _ADMIN_LOCK:
+        _ADMIN_SET.discard(user_id)
 
 @bot.tree.command(name="admin_add_item", description="(แอดมิน) เพิ่มสินค้า")
 @app_commands.describe(
@@ -644,6 +1275,7 @@ def revoke_admin(user_id: int):
     gdrive_url="ลิงก์ Google Drive",
     filename="ชื่อไฟล์ .mp4",
 )
+@admin_only
 async def admin_add_item(
     interaction: Interaction,
     name: str,
@@ -651,10 +1283,8 @@ async def admin_add_item(
     gdrive_url: str,
     filename: Optional[str] = "video.mp4",
 ):
-    msg = require_admin(interaction)
-    if msg:
-        return await interaction.response.send_message(msg, ephemeral=True)
-    item_id = upsert_item(
+    item_id = await _run_db(
+        upsert_item,
         name=name,
         price_cents=to_satang(price_thb),
         gdrive_url=gdrive_url,
@@ -673,6 +1303,7 @@ async def admin_add_item(
     gdrive_url="ลิงก์ใหม่",
     filename="ไฟล์ .mp4",
 )
+@admin_only
 async def admin_edit_item(
     interaction: Interaction,
     item_id: int,
@@ -681,12 +1312,10 @@ async def admin_edit_item(
     gdrive_url: str,
     filename: Optional[str] = "video.mp4",
 ):
-    msg = require_admin(interaction)
-    if msg:
-        return await interaction.response.send_message(msg, ephemeral=True)
-    if not get_item(item_id):
+    if not await _run_db(get_item, item_id):
         return await interaction.response.send_message("ไม่พบสินค้า", ephemeral=True)
-    upsert_item(
+    await _run_db(
+        upsert_item,
         name=name,
         price_cents=to_satang(price_thb),
         gdrive_url=gdrive_url,
@@ -697,54 +1326,42 @@ async def admin_edit_item(
 
 @bot.tree.command(name="admin_delete_item", description="(แอดมิน) ลบสินค้า")
 @app_commands.describe(item_id="รหัสสินค้า")
+@admin_only
 async def admin_delete_item(interaction: Interaction, item_id: int):
-    msg = require_admin(interaction)
-    if msg:
-        return await interaction.response.send_message(msg, ephemeral=True)
-    ok = delete_item(item_id)
+    ok = await _run_db(delete_item, item_id)
     await interaction.response.send_message("ลบเรียบร้อย" if ok else "ไม่พบสินค้า", ephemeral=True)
 
 @bot.tree.command(name="admin_toggle_item", description="(แอดมิน) เปิด/ปิด การขายสินค้า (รายชิ้น)")
 @app_commands.describe(item_id="รหัสสินค้า", active="เปิดขายหรือไม่")
+@admin_only
 async def admin_toggle_item(interaction: Interaction, item_id: int, active: bool):
-    msg = require_admin(interaction)
-    if msg:
-        return await interaction.response.send_message(msg, ephemeral=True)
-    if not get_item(item_id):
+    if not await _run_db(get_item, item_id):
         return await interaction.response.send_message("ไม่พบสินค้า", ephemeral=True)
-    set_item_active(item_id, active)
+    await _run_db(set_item_active, item_id, active)
     await interaction.response.send_message(
         f"{'เปิด' if active else 'ปิด'}การขายสินค้ารหัส #{item_id} แล้ว",
         ephemeral=True,
     )
 
 @bot.tree.command(name="admin_items", description="(แอดมิน) ดูรายการสินค้าทั้งหมด")
+@admin_only
 async def admin_items(interaction: Interaction):
-    msg = require_admin(interaction)
-    if msg:
-        return await interaction.response.send_message(msg, ephemeral=True)
-
-    rows = list_items(active_only=False)
+    rows = await _run_db(list_items, active_only=False)
     if not rows:
         return await interaction.response.send_message("ยังไม่มีสินค้า", ephemeral=True)
 
-    lines: List[str] = []
-    for r in rows:
-        status = "ON" if r["is_active"] else "OFF"
-        item_id = r["id"]
-        name = r["name"]
-        price = fmt_thb(r["price_cents"])
-        lines.append(f"#{item_id} | {status} | {name} | {price}")
+    lines = [
+        f"#{r['id']} | {'ON' if r['is_active'] else 'OFF'} | {r['name']} | {fmt_thb(r['price_cents'])}"
+        for r in rows
+    ]
 
     await interaction.response.send_message("\n".join(lines), ephemeral=True)
 
 @bot.tree.command(name="admin_add_balance", description="(แอดมิน) เติมเงินให้ผู้ใช้")
 @app_commands.describe(user="เลือกผู้ใช้", amount_thb="จำนวนเงิน (บาท)")
+@admin_only
 async def admin_add_balance(interaction: Interaction, user: discord.User, amount_thb: float):
-    msg = require_admin(interaction)
-    if msg:
-        return await interaction.response.send_message(msg, ephemeral=True)
-    add_balance(user.id, to_satang(amount_thb))
+    await _run_db(add_balance, user.id, to_satang(amount_thb))
     await interaction.response.send_message(
         f"เติมเงินให้ {user.mention} จำนวน {amount_thb:.2f} บาท แล้ว",
         ephemeral=True,
@@ -758,11 +1375,9 @@ async def admin_add_balance(interaction: Interaction, user: discord.User, amount
 
 @bot.tree.command(name="admin_shop_toggle", description="(แอดมิน) เปิด/ปิดร้านทั้งระบบ")
 @app_commands.describe(is_open="เปิดร้านหรือไม่")
+@admin_only
 async def admin_shop_toggle(interaction: Interaction, is_open: bool):
-    msg = require_admin(interaction)
-    if msg:
-        return await interaction.response.send_message(msg, ephemeral=True)
-    set_setting("shop_open", "1" if is_open else "0")
+    await _run_db(set_setting, "shop_open", "1" if is_open else "0")
     await interaction.response.send_message(
         "เปิดร้านแล้ว ✅" if is_open else "ปิดร้านแล้ว ⛔",
         ephemeral=True,
@@ -770,11 +1385,9 @@ async def admin_shop_toggle(interaction: Interaction, is_open: bool):
 
 @bot.tree.command(name="admin_check_balance", description="(แอดมิน) เช็คยอดเงินของสมาชิกโดยเลือกชื่อ")
 @app_commands.describe(user="เลือกผู้ใช้ที่ต้องการตรวจสอบ")
+@admin_only
 async def admin_check_balance(interaction: Interaction, user: discord.User):
-    msg = require_admin(interaction)
-    if msg:
-        return await interaction.response.send_message(msg, ephemeral=True)
-    bal = fmt_thb(get_balance(user.id))
+    bal = fmt_thb(await _run_db(get_balance, user.id))
     await interaction.response.send_message(f"ยอดเงินของ {user.mention}: **{bal}**", ephemeral=True)
 
 @bot.tree.command(name="admin_grant", description="(เจ้าของกิลด์) เพิ่มสิทธิ์แอดมิน")
@@ -782,7 +1395,7 @@ async def admin_check_balance(interaction: Interaction, user: discord.User):
 async def admin_grant_cmd(interaction: Interaction, user: discord.User):
     if interaction.guild is None or interaction.user.id != interaction.guild.owner_id:
         return await interaction.response.send_message("คำสั่งนี้ใช้ได้เฉพาะเจ้าของกิลด์", ephemeral=True)
-    grant_admin(user.id)
+    await _run_db(grant_admin, user.id)
     await interaction.response.send_message(f"ให้สิทธิ์แอดมินแก่ {user.mention} แล้ว", ephemeral=True)
 
 @bot.tree.command(name="admin_revoke", description="(เจ้าของกิลด์) ยกเลิกสิทธิ์แอดมิน")
@@ -790,34 +1403,30 @@ async def admin_grant_cmd(interaction: Interaction, user: discord.User):
 async def admin_revoke_cmd(interaction: Interaction, user: discord.User):
     if interaction.guild is None or interaction.user.id != interaction.guild.owner_id:
         return await interaction.response.send_message("คำสั่งนี้ใช้ได้เฉพาะเจ้าของกิลด์", ephemeral=True)
-    revoke_admin(user.id)
+    await _run_db(revoke_admin, user.id)
     await interaction.response.send_message(f"ยกเลิกสิทธิ์แอดมินของ {user.mention} แล้ว", ephemeral=True)
 
 # ---------- STARTUP ----------
 @bot.event
 async def on_ready():
-    db_init()
-    bot.loop.create_task(run_web_server())
-
-    # persistent view (เมนูไม่หมดอายุจนกว่าจะรีสตาร์ทบอท)
-    bot.add_view(MenuView())
-
-    try:
-        for g in bot.guilds:
-            await bot.tree.sync(guild=g)
-            print(f"Synced commands to guild {g.name} ({g.id})")
-    except Exception as e:
-        print("Guild sync error:", e)
-
-    try:
-        synced = await bot.tree.sync()
-        print(f"Synced {len(synced)} global commands")
-    except Exception as e:
-        print("Global sync error:", e)
-
     print(f"Logged in as {bot.user}")
 
+@bot.event
+async def on_guild_channel_delete(channel: discord.abc.GuildChannel):
+    _CHANNEL_CACHE.pop(channel.id, None)
+
 if __name__ == "__main__":
     if not DISCORD_TOKEN:
         raise SystemExit("กรุณาตั้งค่า DISCORD_TOKEN ใน Environment Variables")
+    # Render หยุดเซอร์วิสด้วย SIGTERM: ให้ปิดแบบเดียวกับ Ctrl+C แล้วรัน PRAGMA optimize ก่อนออก
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    # schema + PRAGMA ทำครั้งเดียวก่อนต่อ gateway (ไม่ใช่ทุกครั้งที่ on_ready)
+    db_init()
+    atexit.register(db_optimize)
+    # ใช้ uvloop ถ้ามี (เร็วกว่า loop มาตรฐานทั้ง gateway และ web server); bot.run สร้าง loop ผ่าน policy นี้
+    try:
+        import uvloop
+        uvloop.install()
+    except ImportError:
+        pass
     bot.run(DISCORD_TOKEN)